@@ -13,24 +13,187 @@
 #
 # This file contains the following functions:
 #
-# P = MCMFit(Data,N) which determines an NxN transition matrix P from a
-# time-series in Data.
+# P, a, b = MCMFit(Data,N) which determines an NxN transition matrix P from
+# a time-series in Data, along with the minimum a and maximum b of Data.
+# With MCMFit(Data,N,sparse=True) P is returned as a SciPy sparse matrix,
+# which for large N with few observed transitions makes the matrix power
+# and the returned P cheaper (the fit itself still counts densely).
+#
+# Fit = makeMCMFit(N) which delivers MCMFit with N fixed, called as
+# P, a, b = Fit(Data), for fitting many series with the same N.
+#
+# S = MCMSlidingFit(N,a,b,window) which keeps the NxN transition matrix of
+# a sliding window over a time-series, updated with S.add(sample) and
+# S.popOldest() and returned by S.getTransitionMatrix().
 #
 # X, Y = MCMForecast(P,a,b,obspoint) which delivers a piece-wise uniform
 # distribution (X,Y) from the transition matrix P, minimum a and maximum b
 # of the time-series and obspoint as the observation point to forecast
-# from.
+# from. X holds the bins as Bins(minValue, binWidth, n), the i:th bin
+# starting at minValue + i * binWidth.
+#
+# Y = MCMForecastFast(P,a,w,N,obspoint) which delivers only Y for bins of
+# width w, skipping the checks of MCMForecast for use in rolling forecasts.
+#
+# C = MCMPrepare(P) which delivers the row-wise CDF C of the transition
+# matrix P, to be computed once when forecasting repeatedly from P.
 #
 # NewSamples = MCMRnd(X,Y,Num) which delivers Num number of samples of the
 # distribution X,Y (obtained in MCMForecast), which is the predictive
-# distribution (the forecast).
+# distribution (the forecast). Y can also be taken from C, which is then
+# flagged with MCMRnd(X,Y,Num,cumulative=True).
+#
+# NewSamples = MCMRndParallel(X,Y,Num) which works as MCMRnd but draws the
+# samples on all cores with Numba, for very large Num.
+#
+# NewSamples = MCMRndBatch(X,C,obspoints,Num) which delivers Num samples of
+# the predictive distribution for each of the observations in obspoints,
+# using the CDF C from MCMPrepare.
+#
+# The transition counting in MCMFit is compiled with Numba when it is
+# installed, otherwise with the Cython kernel in _mcm_count.pyx when that
+# has been built (cythonize -i _mcm_count.pyx), and otherwise it runs in
+# NumPy.
 #
 # These functions can all be tested using MCMtest.py, which is accompanied
 # by a test data set TestData.txt
 
+from collections import deque, namedtuple
+from functools import lru_cache
+
 import numpy as np
 
-def MCMFit(data, n, timeSteps=1):
+# Numba is optional, it speeds up the transition counting for long
+# time-series and the parallel sampling but the functions fall back to
+# plain NumPy without it
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# The Cython kernel is the compiled fallback when Numba is missing
+try:
+    from _mcm_count import countTransitions as _countTransitionsCython
+except ImportError:
+    _countTransitionsCython = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _countTransitions(state, n):
+        """Counts the transitions between consecutive states in one pass."""
+        p = np.zeros((n, n))
+        for i in range(1, state.shape[0]):
+            p[state[i-1], state[i]] += 1.0
+        return(p)
+
+    @njit(parallel=True, cache=True)
+    def _rndParallel(minValue, binWidth, probsCDF, count):
+        """Samples the piece-wise uniform distribution over all cores."""
+        n = probsCDF.shape[0]
+        fcstSamples = np.empty(count)
+        for i in prange(count):
+            binIndex = min(np.searchsorted(probsCDF, np.random.random()),
+                           n - 1)
+            fcstSamples[i] = minValue + binWidth \
+                * (binIndex + np.random.random())
+        return(fcstSamples)
+elif _countTransitionsCython is not None:
+    def _countTransitions(state, n):
+        """Counts the transitions between consecutive states in one pass."""
+        p = np.zeros((n, n))
+        _countTransitionsCython(np.ascontiguousarray(state), p)
+        return(p)
+else:
+    def _countTransitions(state, n):
+        """Counts the transitions between consecutive states in one pass."""
+        # Count each (from, to) pair of consecutive states as a single
+        # flattened index, built in place in one index-sized array
+        idx = state[:-1].astype(np.intp)
+        idx *= n
+        idx += state[1:]
+        return(np.bincount(idx, minlength=n*n).reshape(n, n)
+               .astype(np.float64))
+
+
+# The n uniform bins of the piece-wise uniform distribution, the i:th bin
+# starts at minValue + i * binWidth
+Bins = namedtuple('Bins', 'minValue binWidth n')
+
+
+def _asBins(bins):
+    """Returns bins as Bins, also accepting an array of bin starts."""
+    if isinstance(bins, Bins):
+        return(bins)
+    return(Bins(bins[0], float(bins[1] - bins[0]), len(bins)))
+
+
+def _checkTransitions(rowTotals):
+    """Raises if a transition row has no observed transitions."""
+    # A row without any transitions (a state the data never leaves or never
+    # visits) has no predictive distribution to sample from
+    if not np.all(rowTotals > 0):
+        raise ValueError("No transitions from the forecast state were "
+                         + "observed in the data.")
+
+
+def _obsBin(minValue, binWidth, n, obsPoint):
+    """Returns the index of the bin the observation belongs to."""
+    # The bins are uniform so the index follows directly from the distance
+    # to minValue, computed exactly as in _binIndices
+    obsBin = min(int((obsPoint - minValue) / binWidth), n - 1)
+    return(max(obsBin, 0))
+
+
+def _binIndices(values, minValue, binWidth, n):
+    """Returns the indices of the bins an array of values belongs to."""
+    # All values are non-negative after clipping so the cast truncates like
+    # floor, and like the int in _obsBin
+    bins = (values - minValue) / binWidth
+    np.clip(bins, 0, n - 1, out=bins)
+    return(bins.astype(np.int32))
+
+
+def _states(data, n):
+    """Returns the states of the data in n bins and the limits of the data."""
+    # Set up bins and limits
+    a = np.min(data)
+    b = np.max(data)
+    # The compiled transition counting does not check its indices, so the
+    # states have to be guaranteed to lie within the n bins
+    if not (np.isfinite(a) and np.isfinite(b) and a < b):
+        raise ValueError("data must be finite and not constant.")
+    binWidth = (b - a) / n
+
+    # Identify the states for the Markov-chain in the data set
+    return(_binIndices(data, a, binWidth, n), a, b)
+
+
+def _transitionMatrix(counts, timeSteps, sparse, dtype):
+    """Normalizes transition counts into the timeSteps transition matrix."""
+    p = counts.astype(dtype)
+
+    # Normalizing the transition matrix
+    rowSums = p.sum(1)
+    rowSums[rowSums == 0] = 1.0 # do not divide by zero
+    p /= rowSums[:, np.newaxis]
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        p = csr_matrix(p)
+        if timeSteps != 1:
+            p = csr_matrix(p ** timeSteps)
+        return(p)
+
+    # The one step matrix is already the result, only step it further ahead
+    # when asked for (on a contiguous array so the matmul hits BLAS directly)
+    if timeSteps != 1:
+        p = np.linalg.matrix_power(np.ascontiguousarray(p), timeSteps)
+
+    return(p)
+
+
+def MCMFit(data, n, timeSteps=1, sparse=False, dtype=np.float64):
     """Estimates the transition probability to the future time-step.
 
     Parameters
@@ -44,47 +207,174 @@ def MCMFit(data, n, timeSteps=1):
         The time-steps of the returned transition matrix (the default
     is 1, which returns the transition matrix for the following time-
     step).
+    sparse : bool, optional
+        Whether to return the transition matrix as a
+    scipy.sparse.csr_matrix (the default is False). The counts are still
+    gathered in a dense n x n matrix, but for large n where most
+    transitions never occur in the data the matrix power and the returned
+    matrix are much cheaper in CSR.
+    dtype : np.dtype, optional
+        The floating point type of the transition matrix (the default is
+    np.float64). np.float32 halves the memory of the matrix and speeds up
+    the matrix power for large n, at the cost of precision.
 
     Returns
     -------
-    np.array(n,n)
+    np.array(n,n) or scipy.sparse.csr_matrix(n,n)
        The transition matrix for the time-steps.
+    float
+        The minimum value of the data.
+    float
+        The maximum value of the data.
 
     """
-    # Set up bins and limits
-    a = np.min(data)
-    b = np.max(data)
-    binWidth = (b - a) / n
-
-
     # Identify the states for the Markov-chain in the data set
-    state = np.floor((data-a) / binWidth)
-    state[state > (n-1)] = n - 1
-    state = state.astype('int32')
+    state, a, b = _states(data, n)
 
     # Generate the transition matrix
-    p = np.zeros((n,n))
-    for i in range(1,len(data)):
-        p[state[i-1], state[i]]= p[state[i-1], state[i]] + 1
+    p = _transitionMatrix(_countTransitions(state, n), timeSteps, sparse,
+                          dtype)
 
-    # Normalizing the transition matrix
-    rowSums = p.sum(1)
-    rowSums[rowSums == 0] = 1.0 # do not divide by zero
-    p = p / rowSums[:, np.newaxis]
+    # Return the transition matrix and the limits of the data
+    return(p, a, b)
 
-    p = np.linalg.matrix_power(p, timeSteps)
 
-    # Return the transition matrix
-    return(p)
+@lru_cache(maxsize=None)
+def makeMCMFit(n):
+    """Returns MCMFit with the number of states fixed to n.
+
+    A convenience for fitting many series with the same n, the function is
+    created once per n. It is not faster than MCMFit, whose transition
+    counting already runs compiled when Numba or Cython is available.
+
+    Parameters
+    ----------
+    n : int
+        Number of states to be fitted in the transition matrix.
+
+    Returns
+    -------
+    function
+        fit(data, timeSteps=1, sparse=False, dtype=np.float64) returning
+    the transition matrix and the minimum and maximum of the data, like
+    MCMFit.
+
+    """
+    def fit(data, timeSteps=1, sparse=False, dtype=np.float64):
+        return(MCMFit(data, n, timeSteps, sparse, dtype))
+
+    return(fit)
+
+
+class MCMSlidingFit:
+    """Keeps the transition matrix of a sliding window over a time-series.
+
+    Adding or dropping a sample updates the transition counts in constant
+    time, rather than refitting the whole window with MCMFit. The bins are
+    fixed by minValue and maxValue, samples outside of the range fall into
+    the first or last bin.
+
+    Parameters
+    ----------
+    n : int
+        Number of states to be fitted in the transition matrix.
+    minValue : float
+        The minimum value in the range of the data.
+    maxValue : float
+        The maximum value in the range of the data.
+    window : int, optional
+        The number of samples kept, the oldest sample is dropped when a
+    new one is added to a full window (the default is None, which keeps
+    the samples until popOldest is called).
+
+    """
+
+    def __init__(self, n, minValue, maxValue, window=None):
+        assert minValue < maxValue, "minValue must be less than maxValue."
+
+        self.n = n
+        self.minValue = minValue
+        self.maxValue = maxValue
+        self.window = window
+        self.binWidth = (maxValue - minValue) / n
+
+        # The transition counts and the states of the samples in the window
+        self.counts = np.zeros((n, n), dtype=np.int64)
+        self.stateHistory = deque()
+
+    def add(self, sample):
+        """Adds a sample to the end of the window."""
+        state = _obsBin(self.minValue, self.binWidth, self.n, sample)
+
+        if self.stateHistory:
+            self.counts[self.stateHistory[-1], state] += 1
+        self.stateHistory.append(state)
+
+        if self.window is not None and len(self.stateHistory) > self.window:
+            self.popOldest()
+
+    def popOldest(self):
+        """Drops the oldest sample from the window."""
+        state = self.stateHistory.popleft()
+        if self.stateHistory:
+            self.counts[state, self.stateHistory[0]] -= 1
+
+    def getTransitionMatrix(self, timeSteps=1, sparse=False,
+                            dtype=np.float64):
+        """Returns the transition matrix of the samples in the window.
+
+        Parameters
+        ----------
+        timeSteps : int, optional
+            The time-steps of the returned transition matrix (the default
+        is 1).
+        sparse : bool, optional
+            Whether to return the transition matrix as a
+        scipy.sparse.csr_matrix (the default is False).
+        dtype : np.dtype, optional
+            The floating point type of the transition matrix (the default
+        is np.float64).
+
+        Returns
+        -------
+        np.array(n,n) or scipy.sparse.csr_matrix(n,n)
+           The transition matrix for the time-steps.
+
+        """
+        return(_transitionMatrix(self.counts, timeSteps, sparse, dtype))
+
+
+def MCMPrepare(p):
+    """Returns the row-wise CDF of the transition matrix.
+
+    Computing the CDF once lets repeated forecasts from the same transition
+    matrix sample by inverting the CDF without a cumulative sum per call.
+
+    Parameters
+    ----------
+    p : np.array(n,n) or scipy.sparse.csr_matrix(n,n)
+        The transition matrix.
+
+    Returns
+    -------
+    np.array(n,n)
+        The cumulative transition probabilities along each row of p.
+
+    """
+    # The CDF is dense even when p is sparse
+    if not isinstance(p, np.ndarray):
+        p = p.toarray()
+
+    return(np.cumsum(p, axis=1))
 
 
 def MCMForecast(p, minValue, maxValue, obsPoint):
-    """Returns the transition row and the bin stratring values.
+    """Returns the transition row and the bins.
 
     Parameters
     ---------
-    p : np.arange(n,n)
-        The transition matrix.
+    p : np.arange(n,n) or scipy.sparse.csr_matrix(n,n)
+        The transition matrix, or its row-wise CDF from MCMPrepare.
     minValue : float
         The minimum value in the range of the data.
     maxValue : float
@@ -94,11 +384,12 @@ def MCMForecast(p, minValue, maxValue, obsPoint):
 
     Returns
     -------
-    np.array(n,)
-        The bin starting values.
+    Bins
+        The minimum value, width and number of the bins.
     np.array(n,)
         The row in the transition matrix p which represents starting
-    from the observation.
+    from the observation (a row of the CDF if p came from MCMPrepare),
+    always contiguous in memory.
 
     """
     assert minValue < maxValue, "minValue must be less than maxValue."
@@ -111,53 +402,235 @@ def MCMForecast(p, minValue, maxValue, obsPoint):
     # Bin starting values
     binWidth = (maxValue - minValue) / n
 
-    # Calculate the range of the bins
-    binStarts = np.arange(n) * binWidth + minValue
-
     # Identify which bin the obspoint belongs to
-    obsBin = np.where(obsPoint >= binStarts)[0][-1]
+    obsBin = _obsBin(minValue, binWidth, n, obsPoint)
+
+    if isinstance(p, np.ndarray):
+        # The row is returned contiguous so that sampling from it in MCMRnd
+        # stays vectorized even if p is a strided view, e.g. a transpose
+        transProbs = np.ascontiguousarray(p[obsBin, :])
+    else:
+        # A sparse transition matrix only stores the non-zero transitions
+        # of the row, expand it into a dense row
+        transProbs = p[obsBin].toarray().ravel()
 
     # Return the X and Y of the piece-wise uniform distribution
-    return(binStarts, p[obsBin, :])
+    return(Bins(minValue, binWidth, n), transProbs)
+
 
+def MCMForecastFast(p, minValue, binWidth, n, obsPoint):
+    """Returns the transition row without checks or building the bins.
 
-def MCMRnd(binStarts, transProbs, count):
+    Meant for rolling forecasts, where the bins are fixed and only the
+    observation changes between calls.
+
+    Parameters
+    ---------
+    p : np.array(n,n) or scipy.sparse.csr_matrix(n,n)
+        The transition matrix, or its row-wise CDF from MCMPrepare.
+    minValue : float
+        The minimum value in the range of the data.
+    binWidth : float
+        The width of the bins.
+    n : int
+        The number of bins.
+    obsPoint : float
+        Observation from which to forecast.
+
+    Returns
+    -------
+    np.array(n,)
+        The row in the transition matrix p which represents starting
+    from the observation.
+
+    """
+    obsBin = _obsBin(minValue, binWidth, n, obsPoint)
+
+    # A sparse transition matrix is expanded into a dense row, as in
+    # MCMForecast
+    if isinstance(p, np.ndarray):
+        return(p[obsBin])
+    return(p[obsBin].toarray().ravel())
+
+
+def MCMRnd(bins, transProbs, count, cumulative=False, rng=None):
     """Generate random forecasts from a bin.
 
     Parameters
     ----------
-    binStarts : np.array(n,)
-        An array contains the bin starting values.
+    bins : Bins
+        The bins obtained from MCMForecast, an array of the bin starting
+    values is also accepted.
     transProbs : np.array(n,)
         The transition probabilities from the forecast point.
     count : int
         Number of forecast samples.
+    cumulative : bool, optional
+        Whether transProbs already is the CDF of the transition
+    probabilities, e.g. a row obtained from MCMPrepare (the default is
+    False).
+    rng : np.random.Generator, optional
+        The random generator to draw from (the default is None, which
+    creates a new one with np.random.default_rng). Pass a seeded or
+    spawned generator for reproducible or thread-safe sampling.
 
     Returns
     -------
     np.array(count,)
         An array of forecast samples
 
+    Raises
+    ------
+    ValueError
+        If no transitions from the forecast state were observed in the
+    data, i.e. transProbs is all zero.
+
     """
-    # Calculate the bin-width
-    binWidth = np.diff(binStarts)[0]
-    
+    if rng is None:
+        rng = np.random.default_rng()
 
-    # Define the CDF (for later use of inverse CDF)
-    probsCDF = np.cumsum(transProbs)
+    bins = _asBins(bins)
+    transProbs = np.asarray(transProbs)
+    _checkTransitions(transProbs[-1] if cumulative else transProbs.sum())
+
+    if cumulative:
+        # Sampling from the CDF and then obtaining the inverse CDF
+        randWithinECDF = rng.random(count)
+        binIndex = np.searchsorted(transProbs, randWithinECDF, side='left')
+        np.clip(binIndex, 0, bins.n - 1, out=binIndex)
+    else:
+        # Probabilities in lower precision than float64 may not sum to one
+        # within the tolerance of multinomial, rescale them in float64
+        if transProbs.dtype != np.float64:
+            transProbs = transProbs.astype(np.float64)
+            transProbs /= max(transProbs.sum(), 1.0)
+
+        # Draw how many of the samples fall into each bin
+        binCounts = rng.multinomial(count, transProbs)
+        binIndex = np.repeat(np.arange(bins.n), binCounts)
 
-    # Calculating the Num samples from the distribution
-    # First setting initial conditions and a randomizer
-    randWithinECDF = np.random.uniform(0, 1, count)
     # Setting the uniform random variable in each bin
-    randWithinBin = np.random.uniform(0, binWidth, count)
+    fcstSamples = bins.minValue + bins.binWidth \
+        * (binIndex + rng.random(count))
+
+    # The multinomial samples are grouped by bin, shuffle them to keep them
+    # unordered
+    if not cumulative:
+        rng.shuffle(fcstSamples)
+
+    # Return the samples
+    return(fcstSamples)
+
+
+def MCMRndParallel(bins, transProbs, count, cumulative=False):
+    """Generate random forecasts from a bin in parallel with Numba.
+
+    This is meant for very large counts, the samples are drawn over all
+    cores with the random generator of Numba, which cannot be seeded from
+    Python. Without Numba it falls back to MCMRnd.
+
+    Parameters
+    ----------
+    bins : Bins
+        The bins obtained from MCMForecast, an array of the bin starting
+    values is also accepted.
+    transProbs : np.array(n,)
+        The transition probabilities from the forecast point.
+    count : int
+        Number of forecast samples.
+    cumulative : bool, optional
+        Whether transProbs already is the CDF of the transition
+    probabilities, e.g. a row obtained from MCMPrepare (the default is
+    False).
 
+    Returns
+    -------
+    np.array(count,)
+        An array of forecast samples
+
+    Raises
+    ------
+    ValueError
+        If no transitions from the forecast state were observed in the
+    data, i.e. transProbs is all zero.
+
+    """
+    if njit is None:
+        return(MCMRnd(bins, transProbs, count, cumulative))
 
-    fcstSamples = np.zeros(count)
-    # Sampling from the CDF and then obtaining the inverse CDF
-    for i in range(count):
-        binIndex = np.where(randWithinECDF[i] <= probsCDF)[0][0]
-        fcstSamples[i] = binStarts[binIndex] + randWithinBin[i]
+    bins = _asBins(bins)
+
+    # Define the CDF (for later use of inverse CDF)
+    probsCDF = transProbs if cumulative else np.cumsum(transProbs)
+    probsCDF = np.ascontiguousarray(probsCDF, dtype=np.float64)
+    _checkTransitions(probsCDF[-1])
+
+    return(_rndParallel(float(bins.minValue), float(bins.binWidth),
+                        probsCDF, count))
+
+
+def MCMRndBatch(bins, pCDF, obsPoints, count, rng=None):
+    """Generate random forecasts from several observations at once.
+
+    Parameters
+    ----------
+    bins : Bins
+        The bins obtained from MCMForecast, an array of the bin starting
+    values is also accepted.
+    pCDF : np.array(n,n)
+        The row-wise CDF of the transition matrix, obtained from
+    MCMPrepare.
+    obsPoints : np.array(m,)
+        Observations from which to forecast.
+    count : int
+        Number of forecast samples per observation.
+    rng : np.random.Generator, optional
+        The random generator to draw from (the default is None, which
+    creates a new one with np.random.default_rng).
+
+    Returns
+    -------
+    np.array(m,count)
+        An array of forecast samples, one row per observation.
+
+    Raises
+    ------
+    ValueError
+        If no transitions were observed in the data from the state of any
+    of the observations.
+
+    """
+    bins = _asBins(bins)
+    obsPoints = np.asarray(obsPoints)
+    assert np.all(obsPoints >= bins.minValue), "Observations have to be " \
+    + "larger than minValue."
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # The number of bins and observations
+    n = bins.n
+    m = len(obsPoints)
+
+    # Identify which bin each obspoint belongs to
+    obsBins = _binIndices(obsPoints, bins.minValue, bins.binWidth, n)
+    _checkTransitions(pCDF[obsBins, -1])
+
+    # Clipped to at most one, every CDF row lies within [0, 1] (rounding,
+    # especially in float32, can end a row just above one). Shifting row i
+    # (and its random numbers) by i then stacks the rows into one sorted
+    # array which is inverted with a single searchsorted
+    offsets = np.arange(m)[:, np.newaxis]
+    stackedCDF = (np.minimum(pCDF[obsBins], 1.0) + offsets).ravel()
+    randWithinECDF = rng.random((m, count)) + offsets
+    binIndex = np.searchsorted(stackedCDF, randWithinECDF.ravel(),
+                               side='left').reshape(m, count)
+    binIndex -= offsets * n
+    np.clip(binIndex, 0, n - 1, out=binIndex)
+
+    # Setting the uniform random variable in each bin
+    fcstSamples = bins.minValue + bins.binWidth \
+        * (binIndex + rng.random((m, count)))
 
     # Return the samples
     return(fcstSamples)
@@ -27,14 +27,17 @@ steps = 1
 obsPoint = 0.5
 
 # Obtain the NxN transition matrix P from the data
-# and Num number of steps ahead
-p = MCMFit(data, n, steps)
+# and Num number of steps ahead, along with the range of the data
+p, minValue, maxValue = MCMFit(data, n, steps)
 
 # Obtain X and Y for the piecewise uniform distribution
-binStarts, transProbs = MCMForecast(p, data.min(), data.max(), obsPoint)
+bins, transProbs = MCMForecast(p, minValue, maxValue, obsPoint)
 
 # Generate Num random numbers of samples from the forecasted distribution
-fcstSamples = MCMRnd(binStarts, transProbs, num)
+fcstSamples = MCMRnd(bins, transProbs, num)
+
+# The bin starting values for plotting the distribution
+binStarts = bins.minValue + bins.binWidth * np.arange(bins.n)
 
 plt.hist(fcstSamples, 30)
 plt.plot(binStarts, num*transProbs)
@@ -0,0 +1,31 @@
+# cython: language_level=3
+#
+# _mcm_count.pyx is an optional compiled kernel for MCM.py, which counts
+# the transitions in MCMFit when Numba is not installed. Build it in place
+# next to MCM.py with
+#
+#   cythonize -i _mcm_count.pyx
+#
+# MCM.py falls back to plain NumPy when neither is available.
+
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def countTransitions(const int[::1] state, double[:, ::1] p):
+    """Adds the transitions between consecutive states to p.
+
+    Parameters
+    ----------
+    state : np.array(T,) of np.int32
+        The states of the Markov-chain, contiguous in memory. Indices are
+    not checked, every state must lie within [0, n), which MCMFit ensures
+    before calling the kernel.
+    p : np.array(n,n) of np.float64
+        The transition count matrix, updated in place.
+
+    """
+    cdef Py_ssize_t i
+    for i in range(1, state.shape[0]):
+        p[state[i-1], state[i]] += 1.0